@@ -31,8 +31,9 @@ class CharacterLevelParser(abc.ABC):
         """Return True if the parser is in a state where it can end (potentially finished parsing the desired structure), and False otherwise."""
         raise NotImplementedError()
     
-    def shortcut_key(self) -> Optional[str]:
-        """Optional. Return a string that denotes that this state is a repeating state, full tree traversal should be avoided."""
+    def shortcut_key(self) -> Optional[Hashable]:
+        """Optional. Return a string that denotes that this state is a repeating state, full tree traversal should be avoided.
+        Shortcuts that take parameters are denoted by a tuple of the shortcut's name followed by its parameters."""
         return None
     
     def cache_key(self) -> Optional[Hashable]:
@@ -98,7 +99,7 @@ class UnionParser(CharacterLevelParser):
     def can_end(self) -> bool:
         return any([parser.can_end() for parser in self.parsers])
     
-    def shortcut_key(self) -> Optional[str]:
+    def shortcut_key(self) -> Optional[Hashable]:
         return self.parsers[0].shortcut_key() if len(self.parsers) == 1 else None
     
     def cache_key(self) -> Optional[Hashable]:
@@ -140,7 +141,7 @@ class SequenceParser(CharacterLevelParser):
     def can_end(self) -> bool:
         return all([parser.can_end() for parser in self.parsers])
     
-    def shortcut_key(self) -> Optional[str]:
+    def shortcut_key(self) -> Optional[Hashable]:
         return self.parsers[0].shortcut_key() if len(self.parsers) == 1 else None
     
     def cache_key(self) -> Optional[Hashable]:
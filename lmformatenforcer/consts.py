@@ -4,3 +4,4 @@ WHITESPACE_CHARACTERS = " \t\n\r"
 BACKSLASH = "\\"
 BACKSLASH_ESCAPING_CHARACTERS = '"\\/bfnrt'  # Characters allowed after an escaping backslash, except unicode
 BACKSLACH_UNICODE_ESCAPE = "u"
+DECODER_CONTEXT_TOKENS = 5  # Number of preceding tokens decoded together with a new token, to get its characters
@@ -1,4 +1,4 @@
-from typing import List, Set, Tuple
+from typing import List, Optional, Set, Tuple
 try:
     import torch
     from exllamav2 import ExLlamaV2Tokenizer
@@ -28,10 +28,10 @@ class ExLlamaV2TokenEnforcerFilter:
     """ExLlamaV2Sampler.Settings.filters filter that uses the token enforcer to only allow format-complying tokens"""
     token_sequence: List[int]
 
-    def __init__(self, character_level_parser: CharacterLevelParser, tokenizer: ExLlamaV2Tokenizer):
+    def __init__(self, character_level_parser: CharacterLevelParser, tokenizer: ExLlamaV2Tokenizer, max_states: Optional[int] = None):
         regular_tokens = _build_regular_tokens_list(tokenizer)
         self.tokenizer = tokenizer
-        self.token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, self._decode, tokenizer.eos_token_id)
+        self.token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, self._decode, tokenizer.eos_token_id, max_states)
         self.token_sequence = []
 
     def _decode(self, tokens: List[int]) -> str:
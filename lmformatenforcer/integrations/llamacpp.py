@@ -5,7 +5,7 @@ except ImportError:
 from lmformatenforcer import CharacterLevelParser, TokenEnforcer, FormatEnforcerAnalyzer
 import numpy as np
 import numpy.typing as npt
-from typing import Tuple, List
+from typing import Optional, Tuple, List
 
 def _build_regular_tokens_list(llm: Llama) -> List[Tuple[int, str]]:
     token_0 = llm.tokenize(b"0")[-1]
@@ -31,27 +31,34 @@ class LlamaCppLogitsProcessor:
     def __init__(self, token_enforcer: TokenEnforcer, analyze):
         self.token_enforcer = token_enforcer
         self.analyzer = FormatEnforcerAnalyzer(token_enforcer) if analyze else None
+        self.mask: Optional[npt.NDArray[np.bool_]] = None
 
     def __call__(self, input_ids: npt.NDArray[np.intc], scores: npt.NDArray[np.single]) -> npt.NDArray[np.single]:
         token_sequence = input_ids.tolist()
         if self.analyzer:
             self.analyzer.report_raw_logits(token_sequence, scores.tolist())
         allowed_tokens = self.token_enforcer.get_allowed_tokens(token_sequence)
-        mask = np.ones(scores.shape, bool)
-        mask[allowed_tokens] = False
-        scores[mask] = float('-inf')
+        # The mask buffer is allocated once and reused for every step, as the vocabulary size does not change
+        if self.mask is None or self.mask.shape != scores.shape:
+            self.mask = np.ones(scores.shape, bool)
+        else:
+            self.mask.fill(True)
+        self.mask[allowed_tokens] = False
+        scores[self.mask] = float('-inf')
         return scores
     
-def build_llamacpp_logits_processor(llm: Llama, character_level_parser: CharacterLevelParser, analyze: bool=False) -> LlamaCppLogitsProcessor:
+def build_llamacpp_logits_processor(llm: Llama, character_level_parser: CharacterLevelParser, analyze: bool=False,
+                                    max_states: Optional[int] = None) -> LlamaCppLogitsProcessor:
     """Build the logits processor function that llama.cpp will use to filter the tokens generated by the model. The result
-    can be passed in the logits_processor list that is sent to the call or generate() method of llama.cpp models."""
+    can be passed in the logits_processor list that is sent to the call or generate() method of llama.cpp models.
+    max_states is passed to the TokenEnforcer, see TokenEnforcer.__init__()."""
     regular_tokens = _build_regular_tokens_list(llm)
     def decoder(sent: List[int]) -> str:
         try:
             return llm.detokenize(sent).decode('utf-8')
         except:
             return decoder(sent[:-1]) + '�'
-    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, decoder, llm.token_eos())
+    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, decoder, llm.token_eos(), max_states)
     return LlamaCppLogitsProcessor(token_enforcer, analyze)
 
 
@@ -1,4 +1,4 @@
-from typing import Any, Callable, List, Tuple, Union
+from typing import Any, Callable, List, Optional, Tuple, Union
 try:
     from transformers import AutoModelForCausalLM
     from transformers.generation.logits_process import LogitsWarper, PrefixConstrainedLogitsProcessor
@@ -73,11 +73,13 @@ class TransformersPrefixAllowedTokensFn:
 
 
 def build_transformers_prefix_allowed_tokens_fn(tokenizer: PreTrainedTokenizerBase, 
-                                                character_level_parser: CharacterLevelParser) -> TransformersPrefixAllowedTokensFn:
+                                                character_level_parser: CharacterLevelParser,
+                                                max_states: Optional[int] = None) -> TransformersPrefixAllowedTokensFn:
     """Build the prefix allowed tokens function that transformers will use to filter the tokens generated by the model. The result
-    can be passed to the prefix_allowed_tokens_fn parameter of the generate() method of transformers models or pipeline configurations."""
+    can be passed to the prefix_allowed_tokens_fn parameter of the generate() method of transformers models or pipeline configurations.
+    max_states is passed to the TokenEnforcer, see TokenEnforcer.__init__()."""
     regular_tokens = build_regular_tokens_list(tokenizer)
-    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, tokenizer.decode, tokenizer.eos_token_id)
+    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, tokenizer.decode, tokenizer.eos_token_id, max_states)
     return TransformersPrefixAllowedTokensFn(token_enforcer)
 
 
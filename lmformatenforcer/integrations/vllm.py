@@ -5,7 +5,7 @@ except ImportError:
     raise ImportError('vllm is not installed. Please install it with "pip install vllm"')
 from lmformatenforcer import CharacterLevelParser, TokenEnforcer, FormatEnforcerAnalyzer
 from lmformatenforcer.integrations.transformers import build_regular_tokens_list
-from typing import List
+from typing import List, Optional
 import math
 
 
@@ -25,12 +25,14 @@ class VLLMLogitsProcessor:
         return scores
 
 
-def build_vllm_logits_processor(llm: vllm.LLM, character_level_parser: CharacterLevelParser, analyze: bool=False) -> VLLMLogitsProcessor:
+def build_vllm_logits_processor(llm: vllm.LLM, character_level_parser: CharacterLevelParser, analyze: bool=False,
+                                max_states: Optional[int] = None) -> VLLMLogitsProcessor:
     """Build the logits processor function that llama.cpp will use to filter the tokens generated by the model. The result
-    can be passed in the logits_processor list that is sent to the call or generate() method of llama.cpp models."""
+    can be passed in the logits_processor list that is sent to the call or generate() method of llama.cpp models.
+    max_states is passed to the TokenEnforcer, see TokenEnforcer.__init__()."""
     tokenizer = llm.get_tokenizer()
     regular_tokens = build_regular_tokens_list(tokenizer)
-    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, tokenizer.decode, tokenizer.eos_token_id)
+    token_enforcer = TokenEnforcer(regular_tokens, character_level_parser, tokenizer.decode, tokenizer.eos_token_id, max_states)
     return VLLMLogitsProcessor(token_enforcer, analyze)
 
 
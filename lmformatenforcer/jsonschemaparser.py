@@ -1,6 +1,6 @@
 from copy import deepcopy
 import enum
-from typing import Any, List, Optional, Union, cast
+from typing import Any, Hashable, List, Optional, Union, cast
 
 
 from .external.jsonschemaobject import JsonSchemaObject, json_schema_data_formats
@@ -19,6 +19,8 @@ class JsonSchemaParser(CharacterLevelParser):
         # to which parser's stack to add.
         active_parser: "JsonSchemaParser"
         alphabet_without_quotes: str
+        # The alphabet and the backslash, which is the alphabet itself if it already contains a backslash
+        alphabet_with_backslash: str
 
     object_stack: List[CharacterLevelParser]
     context: _Context
@@ -42,6 +44,7 @@ class JsonSchemaParser(CharacterLevelParser):
             self.context.model_class = JsonSchemaObject(**json_schema)
             self.context.active_parser = self
             self.context.alphabet_without_quotes = self.config.alphabet.replace('"', '')
+            self._update_alphabet(self.config.alphabet)
         
         self.num_consecutive_whitespaces = num_consecutive_whitespaces
         if existing_stack is None:
@@ -97,18 +100,37 @@ class JsonSchemaParser(CharacterLevelParser):
     def can_end(self) -> bool:
         return all(parser.can_end() for parser in self.object_stack)
 
-    def shortcut_key(self) -> Optional[str]:
+    def shortcut_key(self) -> Optional[Hashable]:
         if self.object_stack:
             current_parser = self.object_stack[-1]
             if isinstance(current_parser, StringParsingState):
                 if not current_parser.allowed_strings and current_parser.seen_opening_quote and not current_parser.seen_closing_quote \
-                    and current_parser.min_length is None and current_parser.max_length is None:
+                    and current_parser.min_length is None:
                     # Performance optimization: When we are parsing a string that is not from a list of allowed strings, most tokens
                     # are legal. The exploration can be more costly than the LM itself for large tokenizers (because this is pure python),
                     # so we signal that we are in a "freetext" mode, and reuse the allowed token list throughout the run.
-                    return 'json_freetext'
+                    if current_parser.max_length is None:
+                        return 'json_freetext'
+                    # If the string has a maximum length, we also pass how many characters can still be added to it.
+                    # Only tokens that start with a backslash or a quote are explored with this parser. Unlike a full exploration,
+                    # tokens with a backslash after their first character (such as 'ab\\n') and tokens that continue after the closing
+                    # quote (such as 'ok",') are not allowed. The unlimited freetext shortcut above does not allow the latter either.
+                    remaining_length = max(0, current_parser.max_length - len(current_parser.parsed_string))
+                    return ('json_freetext_max_length', remaining_length)
         return None
 
+    def _update_alphabet(self, new_alphabet: str):
+        # Only the alphabet that already followed the config is refreshed here. alphabet_without_quotes (used by strings with
+        # a minimum length) keeps the alphabet the parser was created with, as the tokenizer's alphabet includes characters
+        # such as raw line breaks, which are not valid in JSON strings.
+        # Returning the alphabet object itself lets the TokenEnforcer recognize that all characters are allowed
+        self.context.alphabet_with_backslash = new_alphabet if BACKSLASH in new_alphabet else new_alphabet + BACKSLASH
+
+    @CharacterLevelParser.config.setter
+    def config(self, new_config: CharacterLevelParserConfig):
+        CharacterLevelParser.config.fset(self, new_config)  # Original set
+        self._update_alphabet(new_config.alphabet)
+
 
 class BaseParsingState(CharacterLevelParser):
     def __init__(self, root: JsonSchemaParser):
@@ -482,7 +504,7 @@ class StringParsingState(PrimitiveParsingState):
                 return self.root.context.alphabet_without_quotes + BACKSLASH
             if self.max_length is not None and len(self.parsed_string) >= self.max_length:
                 return '"'
-            return self.root.config.alphabet + BACKSLASH
+            return self.root.context.alphabet_with_backslash
 
     def can_end(self) -> bool:
         if self.require_closing_quote:
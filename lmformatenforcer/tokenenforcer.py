@@ -1,7 +1,9 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from typing import Callable, Collection, Dict, FrozenSet, Hashable, List, Optional, Sequence, Set, Tuple, cast
 import logging
 
+from .consts import BACKSLASH, DECODER_CONTEXT_TOKENS
 from .exceptions import LMFormatEnforcerException
 from .characterlevelparser import CharacterLevelParser, ForceStopParser, CharacterLevelParserConfig
 from .tokenizerprefixtree import TokenizerPrefixTree, TokenizerPrefixTreeNode
@@ -15,11 +17,24 @@ class TokenEnforcer:
         str_so_far: str
         parser: CharacterLevelParser
         allowed_tokens: List[int] = field(default_factory=list)
+        # Prompt states are never evicted, see max_states in __init__()
+        is_prompt: bool = False
+
+    @dataclass
+    class CachedParserState:
+        """A parser state with a cache key, interned with an integer id. Transitions to other cacheable states are recorded lazily."""
+        state_id: int
+        parser: CharacterLevelParser
+        allowed_characters: FrozenSet[str]
+        transitions: Dict[str, 'TokenEnforcer.CachedParserState'] = field(default_factory=dict)
+        # True if the state allows every character of the tokenizer, and stays the same state after any of them
+        accepts_any_string: bool = False
 
     def __init__(self, regular_tokens: List[Tuple[int, str]], 
                  parser: CharacterLevelParser,
                  decoder: Callable[[List[int]], str],
-                 eos_token_id: int):
+                 eos_token_id: int,
+                 max_states: Optional[int] = None):
         """
         Create a new TokenEnforcer.
         :param regular_tokens: A list of tuples (token_id, token_string) for all the regular (not special) tokens in the tokenizer vocabulary.
@@ -27,64 +42,154 @@ class TokenEnforcer:
         :param parser: A CharacterLevelParser that defines the allowed strings.
         :param decoder: A function that decodes a list of token ids into a string.
         :param eos_token_id: The token id of the end-of-string token.
+        :param max_states: Optional. The maximum number of generated token sequence states to keep. When exceeded, the least
+        recently used states are evicted. Prompt states are not counted and are never evicted. By default, all states are kept
+        for the lifetime of the TokenEnforcer.
+        If the previous state of a sequence was evicted, its state is rebuilt from the longest known prompt that the sequence
+        extends, provided that the parser accepts everything decoded after that prompt. Otherwise, the sequence is treated as
+        a new prompt, unless the parser was stopped in the generated text (for example, a finished batch row that received an
+        invalid character), in which case the sequence stays stopped. To tell these apart, the sequences in which the parser
+        was stopped are remembered for the lifetime of the TokenEnforcer, and a sequence whose parser fails only in its last
+        token is treated as stopped.
+        Some cases cannot be told apart from an evicted sequence. A new prompt that extends an earlier prompt only with text
+        that the parser accepts would continue from the earlier prompt's parser, and one in which only the last token is not
+        accepted by the parser would be stopped. To avoid this, max_states should be large enough to keep the states of all of the
+        sequences (batch rows and beams) that are being generated.
         """
-        self.prefix_states: Dict[Hashable, TokenEnforcer.OutputTensorState] = {}
+        if max_states is not None and max_states < 1:
+            raise ValueError(f"max_states must be positive, got {max_states}")
+        self.prefix_states: OrderedDict[Tuple[int, ...], TokenEnforcer.OutputTensorState] = OrderedDict()
+        self.max_states = max_states
+        # The most recent prompt state, and all of the prompt states by their token sequences
+        self.root_state: Optional[TokenEnforcer.OutputTensorState] = None
+        self.prompt_states: Dict[Tuple[int, ...], TokenEnforcer.OutputTensorState] = {}
+        # Sequences in which the parser was switched to ForceStopParser, only recorded when states may be evicted
+        self.stopped_sequences: Set[Tuple[int, ...]] = set()
         self.root_parser = parser
         self.tokenizer_tree = TokenizerPrefixTree(regular_tokens)
         self.decoder = decoder
         self.eos_token_id = eos_token_id
+        # The cached lists are shared by all states with the same parser cache key, and returned to the callers as they are
         self.allowed_token_cache: Dict[Hashable, List[int]] = {}
+        self.parser_state_cache: Dict[Hashable, TokenEnforcer.CachedParserState] = {}
+        # Maps the name of a CharacterLevelParser.shortcut_key() to a function that receives the shortcut's parameters (if any), and returns
+        # the tokens that are allowed without traversing the tokenizer tree and the characters that still have to be explored from its root.
+        self.shortcut_handlers: Dict[Hashable, Callable[..., Tuple[Sequence[int], Collection[str]]]] = {
+            'json_freetext': self._json_freetext_shortcut,
+            'json_freetext_max_length': self._json_freetext_max_length_shortcut,
+        }
         self.regular_tokens = regular_tokens
-        tokenizer_alphabet = "".join(token_str for token_str in self.tokenizer_tree.root.children.keys() if len(token_str) == 1)
-        config = CharacterLevelParserConfig(alphabet=tokenizer_alphabet)
+        # The tree's children are keyed by single characters, so the root's children are exactly the tokenizer's alphabet
+        self.tokenizer_alphabet: FrozenSet[str] = frozenset(self.tokenizer_tree.root.children)
+        config = CharacterLevelParserConfig(alphabet="".join(self.tokenizer_tree.root.children))
         parser.config = config
+        # Parsers that allow any character usually return their config's alphabet as is. If it covers all of the tree's characters,
+        # the traversal recognizes it by identity and explores all of a node's children without intersecting them.
+        self.full_alphabet_str: Optional[str] = config.alphabet if self.tokenizer_alphabet >= self.tokenizer_tree.all_characters else None
 
     def get_allowed_tokens(self, token_sequence: List[int]) -> List[int]:
         """
         Get a list of allowed tokens, given a list of tokens that were already generated.
         :param token_sequence: The tokens that were already generated, and the next token will be generated for.
-        :return: A list of token ids that are allowed to be selected next.
+        :return: A list of token ids that are allowed to be selected next. The list is cached and may be shared between
+        several token sequences, so it must not be modified by the caller.
         """
         # In order to elegantly support beam search and batching, we don't store per-batch information.
         # Instead, we store a hash of all the states (unique token tensors) we encountered so far.
         # When we encounter a new unique token tensor, we find the token tensor that led to it, and continue from there.
+        # Tuples don't cache their hash, so each dictionary access hashes the whole sequence again. The common case (a sequence
+        # we already saw) is therefore resolved with a single lookup, and the previous step is only sliced and hashed on a miss.
         sent_tuple = tuple(token_sequence)
-        prev_step_tuple = sent_tuple[:-1]
-
-        if sent_tuple in self.prefix_states:
+        state = self.prefix_states.get(sent_tuple)
+        if state is not None:
             # We already calculated for this node, return cached list
-            return self.prefix_states[sent_tuple].allowed_tokens
-        elif prev_step_tuple not in self.prefix_states:
+            if self.max_states is not None:
+                self.prefix_states.move_to_end(sent_tuple)
+            return state.allowed_tokens
+
+        prev_step_state = self.prefix_states.get(sent_tuple[:-1])
+        if prev_step_state is not None:
+            # Find the state that led to this node. We explicitly don't use the concept of "timestep" because of beam search
+            state = self._apply_new_characters(prev_step_state, token_sequence)
+            if self.max_states is not None and isinstance(state.parser, ForceStopParser) and \
+                not isinstance(prev_step_state.parser, ForceStopParser):
+                # Continuations of this sequence have to stay stopped, even if their states are evicted
+                self.stopped_sequences.add(sent_tuple)
+        else:
+            # The state that led to this node was evicted, so we rebuild it from the prompt it extends
+            state = self._rebuild_evicted_state(sent_tuple, token_sequence) if self.max_states is not None else None
+        if state is None:
             # We have not encountered the tensor up to the before-last entry. This means that this is the first call - the instruction / prompt tensor.
             # Initialize the root node
             state = TokenEnforcer.OutputTensorState(str_so_far=self.decoder(token_sequence),
-                                                    parser=self.root_parser)
-            self.prefix_states[sent_tuple] = state
-            self._compute_allowed_tokens(state)
-            return state.allowed_tokens
-        else:
-            # Find the state that led to this node. We explicitly don't use the concept of "timestep" because of beam search        
-            prev_step_state = self.prefix_states[prev_step_tuple]
-            new_state = self._apply_new_characters(prev_step_state, token_sequence)
-            self.prefix_states[sent_tuple] = new_state
-            self._compute_allowed_tokens(new_state)
-            return new_state.allowed_tokens
+                                                    parser=self.root_parser,
+                                                    is_prompt=True)
+            self.root_state = state
+            self.prompt_states[sent_tuple] = state
+        self.prefix_states[sent_tuple] = state
+        if self.max_states is not None:
+            self._evict_states()
+        self._compute_allowed_tokens(state)
+        return state.allowed_tokens
+
+    def _rebuild_evicted_state(self, sent_tuple: Tuple[int, ...], token_sequence: List[int]) -> Optional['TokenEnforcer.OutputTensorState']:
+        # The longest prompt that the sequence extends. The prompt may also be empty.
+        prompt_state: Optional[TokenEnforcer.OutputTensorState] = None
+        prompt_length = -1
+        for prompt_tokens, candidate_state in self.prompt_states.items():
+            if prompt_length < len(prompt_tokens) < len(sent_tuple) and sent_tuple[:len(prompt_tokens)] == prompt_tokens:
+                prompt_state = candidate_state
+                prompt_length = len(prompt_tokens)
+        if prompt_state is None:
+            return None
+        characters = self.decoder(token_sequence)
+        if not characters.startswith(prompt_state.str_so_far):
+            return None
+        parser = prompt_state.parser
+        for character_idx in range(len(prompt_state.str_so_far), len(characters)):
+            character = characters[character_idx]
+            if character not in parser.get_allowed_characters():
+                if self._is_stopped_sequence(sent_tuple, prompt_length, token_sequence, character_idx):
+                    return TokenEnforcer.OutputTensorState(str_so_far=characters, parser=ForceStopParser())
+                # Not a continuation that was generated from this prompt, for example a new turn of a conversation
+                return None
+            parser = parser.add_character(character)
+        return TokenEnforcer.OutputTensorState(str_so_far=characters, parser=parser)
+
+    def _is_stopped_sequence(self, sent_tuple: Tuple[int, ...], prompt_length: int, token_sequence: List[int], failed_character_idx: int) -> bool:
+        # A generated sequence that was already stopped before its state was evicted
+        for stopped_tokens in self.stopped_sequences:
+            if prompt_length < len(stopped_tokens) <= len(sent_tuple) and sent_tuple[:len(stopped_tokens)] == stopped_tokens:
+                return True
+        # A generated sequence that is stopped by its last token, like _apply_new_characters() would have done
+        if failed_character_idx >= len(self.decoder(token_sequence[:-1])):
+            self.stopped_sequences.add(sent_tuple)
+            return True
+        return False
+
+    def _evict_states(self):
+        max_states = cast(int, self.max_states)
+        while len(self.prefix_states) - len(self.prompt_states) > max_states:
+            sent_tuple, state = self.prefix_states.popitem(last=False)
+            if state.is_prompt:
+                # Prompt states are never evicted, they are needed to rebuild evicted states
+                self.prefix_states[sent_tuple] = state
 
     def _compute_allowed_tokens(self, state: 'TokenEnforcer.OutputTensorState'):
         try:
             allowed_tokens: List[int] = []
             cache_key = state.parser.cache_key()
-            if cache_key is not None and cache_key in self.allowed_token_cache:
-                state.allowed_tokens = self.allowed_token_cache[cache_key]
-                return
+            if cache_key is not None:
+                cached_allowed_tokens = self.allowed_token_cache.get(cache_key)
+                if cached_allowed_tokens is not None:
+                    state.allowed_tokens = cached_allowed_tokens
+                    return
             shortcut_key = state.parser.shortcut_key()
             self._collect_allowed_tokens(state.parser, self.tokenizer_tree.root, allowed_tokens, shortcut_key)
             if state.parser.can_end():
                 allowed_tokens.append(self.eos_token_id)
             if not allowed_tokens:
                 raise ValueError(f"Parser reached state with no allowed tokens")
-            # root_state = next(state for state in self.prefix_states.values() if state.parser == self.root_parser)
-            # print(f"Allowing {len(allowed_tokens)} tokens after {state.str_so_far[len(root_state.str_so_far):]}")
             state.allowed_tokens = allowed_tokens
             if cache_key is not None:
                 self.allowed_token_cache[cache_key] = allowed_tokens
@@ -94,45 +199,142 @@ class TokenEnforcer:
             raise
         except Exception:
             # Other exceptions are potential bugs and should be reported
-            root_state = next(state for state in self.prefix_states.values() if state.parser == self.root_parser)
-            characters_in_root_node = state.str_so_far[len(root_state.str_so_far):]
+            root_str = self.root_state.str_so_far if self.root_state is not None else ""
+            characters_in_root_node = state.str_so_far[len(root_str):]
             logging.exception(f"Unknown LMFormatEnforcer Problem. Prefix: '{characters_in_root_node}'\n"
                               "Terminating the parser. Please open an issue at \n"
                               "https://github.com/noamgat/lm-format-enforcer/issues with the prefix and "
                               "CharacterLevelParser parameters")
             state.allowed_tokens = [self.eos_token_id]
 
-    def _collect_allowed_tokens(self, parser: CharacterLevelParser, tree_node: TokenizerPrefixTreeNode, allowed_tokens: List[int], shortcut_key: Optional[str]):
-        allowed_tokens.extend(tree_node.tokens)
-        allowed_characters = parser.get_allowed_characters()
-        relevant_characters = tree_node.children.keys()
-        # This next line is the heart of the traversal algorithm. We only explore paths that are shared by both the parser and the tokenizer.
-        characters_to_explore = set(relevant_characters).intersection(allowed_characters)
-        
+    def _collect_allowed_tokens(self, parser: CharacterLevelParser, tree_node: TokenizerPrefixTreeNode, allowed_tokens: List[int], shortcut_key: Optional[Hashable]):
+        # The traversal uses an explicit stack instead of recursion, to avoid python function call overhead on deep trees.
+        # Each entry holds the parser of the parent node (and its CachedParserState, if it is cacheable) and the character that leads
+        # to the entry's node. add_character() is only called when the entry is popped, so that it is immediately followed by
+        # get_allowed_characters() on the resulting parser, exactly like the recursive traversal did (JsonSchemaParser relies on
+        # this order via its context's active_parser).
+        # For cacheable parser states, transitions are looked up in the CachedParserState, so revisiting them (sibling branches,
+        # beam search, repeated states) does not call the parser at all.
+        restricted_characters: Optional[Collection[str]] = None
+        if shortcut_key is not None:
+            shortcut_name, shortcut_args = (shortcut_key[0], shortcut_key[1:]) if isinstance(shortcut_key, tuple) else (shortcut_key, ())
+            shortcut_handler = self.shortcut_handlers.get(shortcut_name)
+            if shortcut_handler is not None:
+                shortcut_tokens, restricted_characters = shortcut_handler(*shortcut_args)
+                allowed_tokens.extend(shortcut_tokens)
+
+        full_alphabet = self.tokenizer_tree.all_characters
+        full_alphabet_str = self.full_alphabet_str
+        subtree_ordered_tokens = self.tokenizer_tree.subtree_ordered_tokens
+        stack: List[Tuple[CharacterLevelParser, Optional[TokenEnforcer.CachedParserState], TokenizerPrefixTreeNode, Optional[str]]] = \
+            [(parser, None, tree_node, None)]
+        while stack:
+            parser, cached_state, tree_node, character = stack.pop()
+            if character is None:
+                cached_state = self._get_cached_parser_state(parser)
+            else:
+                next_cached_state = cached_state.transitions.get(character) if cached_state is not None else None
+                if next_cached_state is None:
+                    parser = parser.add_character(character)
+                    next_cached_state = self._get_cached_parser_state(parser)
+                    if cached_state is not None and next_cached_state is not None:
+                        cached_state.transitions[character] = next_cached_state
+                else:
+                    parser = next_cached_state.parser
+                cached_state = next_cached_state
+
+            if cached_state is not None and cached_state.accepts_any_string and restricted_characters is None:
+                # Every token in this subtree is allowed, and their ids are stored contiguously in the tree
+                allowed_tokens.extend(subtree_ordered_tokens[tree_node.subtree_start:tree_node.subtree_end])
+                continue
+
+            if cached_state is None:
+                allowed_characters = parser.get_allowed_characters()
+            else:
+                allowed_characters = cached_state.allowed_characters
+
+            allowed_tokens.extend(tree_node.tokens)
+            if not tree_node.children:
+                continue
+
+            # Shortcuts only restrict the characters explored from the root of the traversal
+            if restricted_characters is not None:
+                allowed_characters = [character for character in restricted_characters if character in allowed_characters]
+                restricted_characters = None
+            elif allowed_characters is full_alphabet or allowed_characters is full_alphabet_str:
+                allowed_characters = None
+
+            # This next part is the heart of the traversal algorithm. We only explore paths that are shared by both the parser and the tokenizer.
+            # Most nodes have very few children, so testing each child's character is cheaper than intersecting it with the allowed
+            # characters, which would build a new set and iterate over the whole allowed characters string of non-cached parsers.
+            if allowed_characters is None:
+                for character, child in tree_node.children.items():
+                    stack.append((parser, cached_state, child, character))
+            else:
+                for character, child in tree_node.children.items():
+                    if character in allowed_characters:
+                        stack.append((parser, cached_state, child, character))
+
+    def _get_cached_parser_state(self, parser: CharacterLevelParser) -> Optional['TokenEnforcer.CachedParserState']:
+        cache_key = parser.cache_key()
+        if cache_key is None:
+            return None
+        cached_state = self.parser_state_cache.get(cache_key)
+        if cached_state is None:
+            # Parsers usually return a string, which would be iterated character by character in every intersection.
+            # Cacheable parser states convert it to a frozenset once, and reuse it every time the state is visited.
+            allowed_characters = frozenset(parser.get_allowed_characters())
+            # States such as the one of RegexParser('.*') allow any continuation. Detecting them once lets the traversal take
+            # whole subtrees without exploring them. Only states that allow all characters need to check their transitions.
+            all_characters = self.tokenizer_tree.all_characters
+            allows_all_characters = allowed_characters.issuperset(all_characters)
+            if allows_all_characters:
+                # Characters that do not appear in the tree are never explored, so the tree's own set can be used instead.
+                # The traversal recognizes it by identity and skips the intersection.
+                allowed_characters = all_characters
+            accepts_any_string = allows_all_characters and \
+                all(parser.add_character(character).cache_key() == cache_key for character in all_characters)
+            cached_state = TokenEnforcer.CachedParserState(state_id=len(self.parser_state_cache),
+                                                          parser=parser,
+                                                          allowed_characters=allowed_characters,
+                                                          accepts_any_string=accepts_any_string)
+            self.parser_state_cache[cache_key] = cached_state
+        return cached_state
+
+    def _json_freetext_shortcut(self) -> Tuple[Sequence[int], Collection[str]]:
         # Performance optimization: If we are in JSON freetext, all of the tokens that don't contain quote, or end with quote, are legal, so we take
         # their cached list. If the quote character is allowed, we only need to dynamically explore the cases where the string starts with a quote.
         # This breaks the elegance of the API, but otherwise it is a huge performance hit.
-        if shortcut_key == 'json_freetext':
-            allowed_tokens.extend(self.tokenizer_tree.json_freetext_tokens)
-            characters_to_explore = characters_to_explore.intersection(['"'])
-
-        for character in characters_to_explore:
-            next_parser = parser.add_character(character )
-            next_tree_node = tree_node.children[character]
-            self._collect_allowed_tokens(next_parser, next_tree_node, allowed_tokens, None)
-            
+        return self.tokenizer_tree.json_freetext_tokens, '"'
+
+    def _json_freetext_max_length_shortcut(self, remaining_length: int) -> Tuple[Sequence[int], Collection[str]]:
+        # Same as above, but only with the tokens that fit in the remaining length of the string. Tokens that start with
+        # an escape sequence are explored dynamically, so that their length is tracked by the parser.
+        length_offsets = self.tokenizer_tree.json_freetext_length_offsets
+        remaining_length = min(remaining_length, len(length_offsets) - 1)
+        return self.tokenizer_tree.json_freetext_tokens_by_length[:length_offsets[remaining_length]], '"' + BACKSLASH
+
     def _apply_new_characters(self, state: 'TokenEnforcer.OutputTensorState', token_sequence: List[int]):
-        characters = self.decoder(token_sequence)
-        new_state = TokenEnforcer.OutputTensorState(str_so_far=characters, parser=state.parser)
-        new_characters = characters[len(state.str_so_far):]
-        for character in new_characters:
-            if character in new_state.parser.get_allowed_characters():
-                new_state.parser = new_state.parser.add_character(character)
+        # Decoding the whole sequence on every step is O(n) per token. Instead, decode a short window of the last tokens with and
+        # without the new token, and take the difference. The preceding tokens give the decoder context (leading whitespace,
+        # multi-token characters). If the shorter decoding is not a prefix of the longer one, fall back to decoding the whole sequence.
+        window = token_sequence[-(DECODER_CONTEXT_TOKENS + 1):]
+        prev_window_characters = self.decoder(window[:-1])
+        window_characters = self.decoder(window)
+        if window_characters.startswith(prev_window_characters):
+            new_characters = window_characters[len(prev_window_characters):]
+            characters = state.str_so_far + new_characters
+        else:
+            characters = self.decoder(token_sequence)
+            new_characters = characters[len(state.str_so_far):]
+        return TokenEnforcer.OutputTensorState(str_so_far=characters, parser=self._apply_characters(state.parser, new_characters))
+
+    def _apply_characters(self, parser: CharacterLevelParser, characters: str) -> CharacterLevelParser:
+        for character in characters:
+            if character in parser.get_allowed_characters():
+                parser = parser.add_character(character)
             else:
                 # This can happen in beam / batch scenarios, when some of the batches finished but others are continuing.
                 logging.debug(f"Received an invalid character '{character}', switching to ForceStopParser")
-                new_state.parser = ForceStopParser()
-        return new_state
-        
-
-    
\ No newline at end of file
+                parser = ForceStopParser()
+        return parser
@@ -1,16 +1,35 @@
-from typing import Dict, List, Tuple
+from typing import Dict, FrozenSet, List, Sequence, Tuple, cast
+
+from .consts import BACKSLASH
 
 
 class TokenizerPrefixTreeNode:
+    # Tokenizer trees have hundreds of thousands of nodes. Slots give them a compact fixed layout instead of a per-node __dict__,
+    # which reduces memory and garbage collection work, and makes attribute access in the traversal faster.
+    __slots__ = ('tokens', 'children', 'subtree_start', 'subtree_end')
+
     def __init__(self):
-        self.tokens: List[int] = []
+        # A list while the tree is being built, converted to a tuple once it is complete.
+        self.tokens: Sequence[int] = []
         self.children: Dict[str, TokenizerPrefixTreeNode] = {}
+        # The tokens of this node and all of its descendants are TokenizerPrefixTree.subtree_ordered_tokens[subtree_start:subtree_end]
+        self.subtree_start = 0
+        self.subtree_end = 0
 
 
 class TokenizerPrefixTree:
     def __init__(self, regular_tokens: List[Tuple[int, str]]):
         self.root = TokenizerPrefixTreeNode()
+        # All of the tree's tokens, ordered so that the tokens of every subtree are contiguous
+        self.subtree_ordered_tokens: List[int] = []
+        # All of the characters that appear in any token
+        self.all_characters: FrozenSet[str] = frozenset()
         self.json_freetext_tokens: List[int] = []
+        # Subset of json_freetext_tokens that can be used in length limited JSON string fields, sorted by the length they add to the string.
+        # json_freetext_length_offsets[k] is the number of tokens in the list that add at most k characters.
+        self.json_freetext_tokens_by_length: List[int] = []
+        self.json_freetext_length_offsets: List[int] = []
+        token_lengths: List[Tuple[int, int]] = []
         for token_idx, decoded in regular_tokens:
             self._add_token_to_tree(decoded, token_idx, self.root)
             # Performance optimization - cache the tokens of all the strings that don't contain a quote in the middle, or a line break.
@@ -20,10 +39,42 @@ class TokenizerPrefixTree:
 
             if not (has_quote_before_end or has_newline):
                 self.json_freetext_tokens.append(token_idx)
+                # Tokens that start with a quote or contain escape sequences are left for the dynamic tree traversal.
+                # A closing quote at the end of the token does not count towards the string's length.
+                if decoded and not decoded.startswith('"') and BACKSLASH not in decoded:
+                    string_length = len(decoded) - 1 if decoded.endswith('"') else len(decoded)
+                    token_lengths.append((string_length, token_idx))
+        token_lengths.sort()
+        self.json_freetext_tokens_by_length = [token_idx for _, token_idx in token_lengths]
+        max_string_length = token_lengths[-1][0] if token_lengths else 0
+        self.json_freetext_length_offsets = [0] * (max_string_length + 1)
+        for string_length, _ in token_lengths:
+            self.json_freetext_length_offsets[string_length] += 1
+        for length in range(1, max_string_length + 1):
+            self.json_freetext_length_offsets[length] += self.json_freetext_length_offsets[length - 1]
+        self._finalize_nodes()
 
     def _add_token_to_tree(self, token_str: str, token_idx: int, node: TokenizerPrefixTreeNode):
         for character in token_str:
             if character not in node.children:
                 node.children[character] = TokenizerPrefixTreeNode()
             node = node.children[character]
-        node.tokens.append(token_idx)
+        cast(List[int], node.tokens).append(token_idx)
+
+    def _finalize_nodes(self):
+        # Depth first traversal. Each node is pushed again (with subtree_visited=True) below its children, and popped once its whole subtree was visited.
+        all_characters = set()
+        nodes_to_visit: List[Tuple[TokenizerPrefixTreeNode, bool]] = [(self.root, False)]
+        while nodes_to_visit:
+            node, subtree_visited = nodes_to_visit.pop()
+            if subtree_visited:
+                node.subtree_end = len(self.subtree_ordered_tokens)
+                continue
+            node.tokens = tuple(node.tokens)
+            node.subtree_start = len(self.subtree_ordered_tokens)
+            self.subtree_ordered_tokens.extend(node.tokens)
+            nodes_to_visit.append((node, True))
+            if node.children:
+                all_characters.update(node.children)
+                nodes_to_visit.extend((child, False) for child in node.children.values())
+        self.all_characters = frozenset(all_characters)
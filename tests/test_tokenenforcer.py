@@ -0,0 +1,207 @@
+from typing import List, Optional, Tuple
+from pydantic import BaseModel, Field
+from lmformatenforcer import CharacterLevelParser, JsonSchemaParser, RegexParser, TokenEnforcer
+from lmformatenforcer.consts import COMPLETE_ALPHABET
+
+
+_EOS_TOKEN_ID = 0
+
+
+def _build_regular_tokens(multi_character_tokens: List[str]) -> List[Tuple[int, str]]:
+    token_strs = list(COMPLETE_ALPHABET) + multi_character_tokens
+    return [(token_idx + 1, token_str) for token_idx, token_str in enumerate(token_strs)]
+
+
+def _is_string_allowed(parser: CharacterLevelParser, string: str) -> bool:
+    for character in string:
+        if character not in parser.get_allowed_characters():
+            return False
+        parser = parser.add_character(character)
+    return True
+
+
+class _TokenEnforcerHarness:
+    def __init__(self, parser: CharacterLevelParser, multi_character_tokens: List[str], max_states: Optional[int] = None):
+        self.regular_tokens = _build_regular_tokens(multi_character_tokens)
+        self.token_strs = dict(self.regular_tokens)
+        self.token_ids = {token_str: token_idx for token_idx, token_str in self.regular_tokens}
+        self.token_enforcer = TokenEnforcer(self.regular_tokens, parser, self.decode, _EOS_TOKEN_ID, max_states)
+
+    def decode(self, tokens: List[int]) -> str:
+        return "".join(self.token_strs.get(token, "") for token in tokens)
+
+    def get_allowed_token_strs(self, token_strs: List[str]) -> List[str]:
+        token_sequence = [self.token_ids[token_str] for token_str in token_strs]
+        # The token enforcer expects to see every prefix of the sequence, starting from the (empty) prompt
+        for prefix_length in range(len(token_sequence) + 1):
+            allowed_tokens = self.token_enforcer.get_allowed_tokens(token_sequence[:prefix_length])
+        return [self.token_strs[token] for token in allowed_tokens if token != _EOS_TOKEN_ID]
+
+    def get_allowed_token_strs_directly(self, token_strs: List[str]) -> List[str]:
+        # Unlike get_allowed_token_strs(), only the sequence itself is queried, like a new prompt or a step of one batch row
+        allowed_tokens = self.token_enforcer.get_allowed_tokens([self.token_ids[token_str] for token_str in token_strs])
+        return sorted(self.token_strs[token] for token in allowed_tokens if token != _EOS_TOKEN_ID)
+
+
+def _assert_allowed_tokens_are_valid(harness: _TokenEnforcerHarness, parser: CharacterLevelParser, token_strs: List[str]):
+    prefix = "".join(token_strs)
+    for allowed_token_str in harness.get_allowed_token_strs(token_strs):
+        if not _is_string_allowed(parser, prefix + allowed_token_str):
+            raise ValueError(f"Token '{allowed_token_str}' was allowed after '{prefix}' but is not accepted by the parser")
+
+
+def test_json_freetext_max_length():
+    class TestModel(BaseModel):
+        short: str = Field(..., max_length=5)
+
+    parser = JsonSchemaParser(TestModel.schema())
+    harness = _TokenEnforcerHarness(parser, ['{"', 'short', '": "', 'ab', 'abc', 'abcd', 'abcdef', 'ab"', 'abcdef"', '"}'])
+    prefix = ['{"', 'short', '": "']
+
+    allowed = harness.get_allowed_token_strs(prefix)
+    assert 'abc' in allowed and 'ab"' in allowed and '"}' in allowed
+    assert 'abcdef' not in allowed and 'abcdef"' not in allowed
+    _assert_allowed_tokens_are_valid(harness, parser, prefix)
+
+    allowed = harness.get_allowed_token_strs(prefix + ['abcd'])
+    assert 'a' in allowed and '"}' in allowed
+    assert 'ab' not in allowed and 'ab"' not in allowed
+    _assert_allowed_tokens_are_valid(harness, parser, prefix + ['abcd'])
+
+
+def test_json_freetext_max_length_explored_tokens():
+    # Only tokens that start with a backslash or a quote are explored with the parser in length limited strings. Tokens with an
+    # escape sequence after their first character, or that continue after the closing quote, are not allowed by the shortcut.
+    class TestModel(BaseModel):
+        short: str = Field(..., max_length=5)
+        other: int = 0
+
+    parser = JsonSchemaParser(TestModel.schema())
+    harness = _TokenEnforcerHarness(parser, ['{"', 'short', '": "', 'ab', '\\n', 'ab\\n', 'ok"', 'ok",', 'ok"}'])
+    prefix = ['{"', 'short', '": "']
+
+    allowed = harness.get_allowed_token_strs(prefix)
+    assert 'ab' in allowed and '\\n' in allowed and 'ok"' in allowed
+    assert 'ab\\n' not in allowed and 'ok",' not in allowed and 'ok"}' not in allowed
+    _assert_allowed_tokens_are_valid(harness, parser, prefix)
+
+
+def test_regex_allowed_tokens_match_parser():
+    # RegexParser states are cacheable, so this also covers the transition cache of the traversal
+    parser = RegexParser(r'(ab|ba)+c[0-9]{1,3}')
+    harness = _TokenEnforcerHarness(parser, ['ab', 'ba', 'abab', 'aba', 'bab', 'abc', 'bac1', 'c12', '123', '1234', 'cab'])
+    token_strs = ['ab', 'aba', 'bab', 'c12']
+    for prefix_length in range(len(token_strs) + 1):
+        prefix = token_strs[:prefix_length]
+        prefix_str = "".join(prefix)
+        allowed = set(harness.get_allowed_token_strs(prefix))
+        expected = set(token_str for _, token_str in harness.regular_tokens if _is_string_allowed(parser, prefix_str + token_str))
+        assert allowed == expected
+
+
+def test_regex_any_string_subtrees():
+    # Once the parser is in a state that accepts any string, whole subtrees of the tokenizer tree are allowed without exploring them
+    parser = RegexParser(r'ab(.*)')
+    harness = _TokenEnforcerHarness(parser, ['ab', 'ba', 'abab', 'aba', 'bab', 'abc', 'c12', '123', '1234'])
+    token_strs = ['ab', 'c12', 'bab']
+    for prefix_length in range(len(token_strs) + 1):
+        prefix = token_strs[:prefix_length]
+        prefix_str = "".join(prefix)
+        allowed = harness.get_allowed_token_strs(prefix)
+        expected = [token_str for _, token_str in harness.regular_tokens if _is_string_allowed(parser, prefix_str + token_str)]
+        assert sorted(allowed) == sorted(expected)
+    assert any(cached_state.accepts_any_string for cached_state in harness.token_enforcer.parser_state_cache.values())
+
+
+def test_decoder_that_strips_leading_whitespace():
+    # Sentencepiece-style decoders drop the leading whitespace of the first decoded token, so the characters of a new
+    # token have to be decoded in the context of the tokens that precede it.
+    parser = RegexParser(r'a( b){8}')
+    harness = _TokenEnforcerHarness(parser, [' b'])
+    harness.decode = lambda tokens: "".join(harness.token_strs.get(token, "") for token in tokens).lstrip(" ")
+    harness.token_enforcer.decoder = harness.decode
+    token_strs = ['a'] + [' b'] * 8
+    for prefix_length in range(1, len(token_strs)):
+        assert ' b' in harness.get_allowed_token_strs(token_strs[:prefix_length])
+    assert harness.get_allowed_token_strs(token_strs) == []
+
+
+def test_max_states_eviction():
+    multi_character_tokens = ['ab', 'ba', 'abab', 'aba', 'bab', 'abc', 'c12', '123']
+    token_strs = ['ab', 'aba', 'bab', 'ab', 'c12']
+    unbounded = _TokenEnforcerHarness(RegexParser(r'(ab|ba)+c[0-9]{1,3}'), multi_character_tokens)
+    bounded = _TokenEnforcerHarness(RegexParser(r'(ab|ba)+c[0-9]{1,3}'), multi_character_tokens, max_states=2)
+    for prefix_length in range(len(token_strs) + 1):
+        prefix = token_strs[:prefix_length]
+        assert set(bounded.get_allowed_token_strs(prefix)) == set(unbounded.get_allowed_token_strs(prefix))
+        # Prompt states are not counted, and never evicted
+        token_enforcer = bounded.token_enforcer
+        assert len(token_enforcer.prefix_states) - len(token_enforcer.prompt_states) <= 2
+    # Querying a sequence whose previous state was evicted rebuilds it from the prompt
+    prefix = token_strs[:3]
+    token_sequence = [bounded.token_ids[token_str] for token_str in prefix]
+    allowed_tokens = bounded.token_enforcer.get_allowed_tokens(token_sequence)
+    assert set(bounded.token_strs[token] for token in allowed_tokens) == set(unbounded.get_allowed_token_strs(prefix))
+
+
+def test_max_states_multi_turn_prompt():
+    # The second prompt extends the first conversation with a new turn that the parser does not accept,
+    # so it has to be treated as a new prompt and not as an evicted continuation of the first one.
+    multi_character_tokens = ['ab', 'Q:', 'A:']
+    first_prompt = ['Q:', 'x', 'A:']
+    second_prompt = first_prompt + ['a', 'b', 'Q:', 'y', 'A:']
+    for max_states in [None, 3, 1]:
+        harness = _TokenEnforcerHarness(RegexParser(r'ab?'), multi_character_tokens, max_states)
+        assert harness.get_allowed_token_strs_directly(first_prompt) == ['a', 'ab']
+        for generated_length in range(1, 3):
+            harness.get_allowed_token_strs_directly(second_prompt[:len(first_prompt) + generated_length])
+        assert harness.get_allowed_token_strs_directly(second_prompt) == ['a', 'ab']
+        assert harness.get_allowed_token_strs_directly(second_prompt + ['a']) == ['b']
+
+
+def test_max_states_batch_with_different_prompts():
+    # Rows of a batch that started from different prompts evict each other's states on every step
+    multi_character_tokens = ['ab', 'X:', 'Y:']
+    prompts = [['X:'], ['Y:']]
+    for max_states in [None, 1]:
+        harness = _TokenEnforcerHarness(RegexParser(r'(ab)+c'), multi_character_tokens, max_states)
+        for prompt in prompts:
+            assert 'ab' in harness.get_allowed_token_strs_directly(prompt)
+        for generated_length in range(1, 4):
+            for prompt in prompts:
+                allowed = harness.get_allowed_token_strs_directly(prompt + ['ab'] * generated_length)
+                assert 'ab' in allowed and 'c' in allowed
+
+
+def test_json_min_length_string():
+    class TestModel(BaseModel):
+        name: str = Field(..., min_length=3)
+
+    parser = JsonSchemaParser(TestModel.schema())
+    harness = _TokenEnforcerHarness(parser, ['{"', 'name', '": "', 'abc', '\n', '\t', 'a\nb', '"}'])
+    prefix = ['{"', 'name', '": "']
+
+    allowed = harness.get_allowed_token_strs(prefix)
+    assert 'a' in allowed and 'abc' in allowed
+    # Raw line breaks and tabs are not valid in JSON strings
+    assert '\n' not in allowed and '\t' not in allowed and 'a\nb' not in allowed
+    assert '"' not in allowed and '"}' not in allowed
+
+    allowed = harness.get_allowed_token_strs(prefix + ['abc'])
+    assert '"}' in allowed
+
+
+def test_max_states_stopped_batch_rows():
+    # Rows that received an invalid character are stopped, and have to stay stopped when their states are evicted
+    multi_character_tokens = ['ab', 'X:']
+    prompt = ['X:']
+    rows = [['a', 'b', 'a', 'a', 'a'], ['a', 'b', 'b', 'b', 'b'], ['ab', 'a', 'b', 'a', 'a']]
+    unbounded = _TokenEnforcerHarness(RegexParser(r'ab'), multi_character_tokens)
+    bounded = _TokenEnforcerHarness(RegexParser(r'ab'), multi_character_tokens, max_states=1)
+    for generated_length in range(len(rows[0]) + 1):
+        for row in rows:
+            token_strs = prompt + row[:generated_length]
+            expected = unbounded.get_allowed_token_strs_directly(token_strs)
+            assert bounded.get_allowed_token_strs_directly(token_strs) == expected
+    assert unbounded.get_allowed_token_strs_directly(prompt + rows[0]) == []
+    assert len(bounded.token_enforcer.prompt_states) == 1